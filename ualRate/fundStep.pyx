@@ -0,0 +1,45 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""Compiled build of pensFund._step(), which pensFund uses when numba isn't
+installed. Build it in place with:
+
+    python setup.py build_ext --inplace
+"""
+import numpy as np
+from cython cimport floating
+
+
+def step(floating[:] assets, floating[:] pcts, floating[:] rates, double premiums, double benefits):
+    """Same as pensFund._step(): one year of investment earnings, premiums,
+    benefits and payGo. Returns (new_assets, r, A, payGo, new_total)."""
+    cdef Py_ssize_t i, n = assets.shape[0]
+    cdef double A = 0, total = 0, newTotal = 0, payGo = 0, r, scale
+    cdef floating[:] out
+
+    if floating is float:
+        new = np.empty(n, dtype=np.float32)
+    else:
+        new = np.empty(n, dtype=np.float64)
+    out = new
+
+    for i in range(n):
+        A += assets[i]
+        out[i] = assets[i] * (1 + rates[i])
+        total += out[i]
+    r = (total - A) / A if A != 0 else 0.0
+
+    # Premiums and benefits both go by the current shares, as in _step().
+    scale = total + premiums - benefits
+    for i in range(n):
+        if total != 0:
+            out[i] = out[i] / total * scale
+        else:
+            out[i] = pcts[i] * scale
+        newTotal += out[i]
+
+    if newTotal < 0:
+        for i in range(n):
+            if out[i] < 0:
+                payGo -= out[i]
+                out[i] = 0
+        newTotal += payGo
+    return new, r, A, payGo, newTotal
@@ -1,102 +1,177 @@
 #!/usr/bin/env python3
 import numpy as np
 
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    # numba is optional; without it the kernels below just run as plain Python, apart from _step(), which can come
+    # from the compiled fundStep extension instead (see setup.py).
+    HAVE_NUMBA = False
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+
+@njit(cache=True)
+def _step(assets, pcts, rates, premiums, benefits):
+    """One year of a fund: investment earnings, then premiums, then benefits
+    and any payGo shortfall, as in pensPlan.advanceOneYear(). Returns
+    (new_assets, r, A, payGo, new_total) and leaves assets untouched."""
+    A = assets.sum()
+    new = assets * (1 + rates)
+    total = new.sum()
+    r = (total - A) / A if A != 0 else 0.0
+
+    # Premiums and benefits are both split by the fund's current shares, and
+    # adding or removing money that way leaves the shares as they were, so
+    # both can be applied at once.
+    w = new / total if total != 0 else pcts
+    new = w * (total + premiums - benefits)
+
+    # Masked rather than branched, as in pensFund.payGo(). Multiplying by masks
+    # (rather than taking a minimum with 0.0) keeps float32 assets in float32.
+    shortfall = (new.sum() < 0) * (new < 0) * new
+    new = new - shortfall
+    return new, r, A, 0.0 - shortfall.sum(), new.sum()
+
+
+if not HAVE_NUMBA:
+    try:
+        from fundStep import step as _step
+    except ImportError:
+        pass
+
+
+@njit(cache=True)
+def simulateFunds(assets, pcts, rates, premiums, benefits):
+    """Run _step() for every year and run of a (years, size, 3) matrix of
+    returns, each run starting from the same assets. premiums and benefits
+    hold one value per year. All the inputs should share a dtype. Returns the
+    total assets, r, A and payGo of every year and run, each as a
+    (years, size) array of that dtype."""
+    # Single-threaded on purpose: getModelData() already spreads the runs over processes, and numba's threading
+    # layer doesn't survive being forked into its Pool.
+    years, size = rates.shape[0], rates.shape[1]
+    total = np.empty((years, size), rates.dtype)
+    r = np.empty((years, size), rates.dtype)
+    A = np.empty((years, size), rates.dtype)
+    payGo = np.empty((years, size), rates.dtype)
+    for i in range(size):
+        a = assets.copy()
+        for t in range(years):
+            a, rt, At, pt, total[t, i] = _step(a, pcts, rates[t, i], premiums[t], benefits[t])
+            r[t, i] = rt
+            A[t, i] = At
+            payGo[t, i] = pt
+    return total, r, A, payGo
+
 
 class pensFund(object):
-    def __init__(self, assetTotal, currYear, volatility, pctE=0.6, pctB=0.3, pctO=0.1):
+    def __init__(self, assetTotal, currYear, volatility, pctE=0.6, pctB=0.3, pctO=0.1, years=0, seed=None,
+                 rng=None):
         self.currentYear = currYear
-        self.pcts = [pctE, pctB, pctO]
+        self.pcts = np.array([pctE, pctB, pctO])
         self.vol = volatility
-
-        self.equity = round(self.pcts[0] * assetTotal, 2)
-        self.bonds = round(self.pcts[1] * assetTotal, 2)
-        self.other = round(self.pcts[2] * assetTotal, 2)
-
-        self.ledger = {self.currentYear: [self.equity, self.bonds, self.other]}
+        # vol is laid out [mean, sd, mean, sd, mean, sd].
+        self.means = np.asarray(self.vol[0::2])
+        self.stds = np.asarray(self.vol[1::2])
+
+        # Investment returns for the first `years` years are drawn up front, in a single call.
+        # rng is a numpy Generator; if none is given, one is made from seed.
+        if rng is None:
+            rng = np.random.default_rng(seed)
+        self.rng = rng
+        self.shocks = self.rng.standard_normal((years, 3)) * self.stds + self.means
+        self.shockIndex = 0
+
+        self.assets = self.pcts * assetTotal
+
+        # One row of balances per year from startYear on, sized from the years hint. Rows for years that haven't
+        # been recorded are NaN.
+        self.startYear = currYear
+        self.ledger = np.full((years + 1, 3), np.nan)
+        self.ledger[0] = self.assets
 
     def annualReport(self, year=0):
         if year == 0:
             year = self.currentYear
 
-        if year in self.ledger:
-            report = self.ledger[year]
-            out = ("Assets:\n\tEquity = $%s\n\tBonds = $%s\n\tOther = $%s\nTotal: $%s" %
-                   ('{:,}'.format(report[0]), '{:,}'.format(report[1]), '{:,}'.format(report[2]),
-                    '{:,}'.format(round(sum(report), 2))))
+        row = year - self.startYear
+        if 0 <= row < len(self.ledger) and not np.isnan(self.ledger[row, 0]):
+            # Balances are kept exact; they're only rounded to the cent for display.
+            report = self.ledger[row]
+            out = (f"Assets:\n\tEquity = ${report[0]:,.2f}\n\tBonds = ${report[1]:,.2f}\n\tOther = ${report[2]:,.2f}"
+                   f"\nTotal: ${report.sum():,.2f}")
             return out
         else:
-            return "Assets could not be found for the year %.0f." % year
+            return f"Assets could not be found for the year {year:.0f}."
 
     def printReport(self):
         print(self.annualReport())
 
     def addPremiums(self, premiums):
-        total = self.equity + self.bonds + self.other
-        if total == 0:
-            self.equity += self.pcts[0] * premiums
-            self.bonds += self.pcts[1] * premiums
-            self.other += self.pcts[2] * premiums
-        else:
-            self.equity += (self.equity / total) * premiums
-            self.bonds += (self.bonds / total) * premiums
-            self.other += (self.other / total) * premiums
+        total = self.assets.sum()
+        w = self.assets / total if total else self.pcts
+        self.assets += w * premiums
 
     def payGo(self):
-        total = self.equity + self.bonds + self.other
-        if total >= 0:
-            return 0
-
-        total = 0
-        for asset in [self.equity, self.bonds, self.other]:
-            if asset < 0:
-                total -= asset
-
-        self.equity = max(self.equity, 0)
-        self.bonds = max(self.bonds, 0)
-        self.other = max(self.other, 0)
-
-        return total
+        # Only a fund whose total has gone negative is topped back up, by the sum of its negative balances.
+        # The mask stands in for branching on the total, so the clamp is a couple of ufunc calls.
+        shortfall = (self.assets.sum() < 0) * np.minimum(self.assets, 0.0)
+        self.assets -= shortfall
+        return 0.0 - shortfall.sum()
 
     def payBenefits(self, benefits):
-        total = self.equity + self.bonds + self.other
-        if total == 0:
-            self.equity -= self.pcts[0] * benefits
-            self.bonds -= self.pcts[1] * benefits
-            self.other -= self.pcts[2] * benefits
-        else:
-            self.equity -= (self.equity / total) * benefits
-            self.bonds -= (self.bonds / total) * benefits
-            self.other -= (self.other / total) * benefits
+        total = self.assets.sum()
+        w = self.assets / total if total else self.pcts
+        self.assets -= w * benefits
         return self.payGo()
 
-    def addInvestmentEarnings(self):
-        e = np.random.normal(self.vol[0], self.vol[1])
-        b = np.random.normal(self.vol[2], self.vol[3])
-        o = np.random.normal(self.vol[4], self.vol[5])
+    def nextRates(self):
+        """Investment returns for the coming year."""
+        # Use the pre-drawn returns while they last, then draw one year at a time.
+        if self.shockIndex < len(self.shocks):
+            rates = self.shocks[self.shockIndex]
+        else:
+            rates = self.rng.standard_normal(3) * self.stds + self.means
+        self.shockIndex += 1
         # defaults: [0.06, 0.03, 0.04, 0.01, 0.06, 0.05]
+        return rates
+
+    def annualStep(self, contribution, benefits, rates=None):
+        """Investment earnings, then the contribution, then benefits and payGo
+        for one year, in a single step on the fund's assets. rates defaults to
+        the next year's investment returns. Returns [r, A, payGo, total], total
+        being the assets left at the end of the year."""
+        if rates is None:
+            rates = self.nextRates()
+        self.assets, r, A, payGo, total = _step(self.assets, self.pcts, rates, contribution, benefits)
+        # Plain floats, not numpy scalars, so that dividing by a zero UAL or payroll in pensPlan still raises
+        # ZeroDivisionError whichever _step() is in use.
+        return [float(r), float(A), float(payGo), float(total)]
 
-        # print("Investment Earnings amount to $%s" % '{:,}'.format(round(earnings, 2)))
-
-        A = self.equity + self.bonds + self.other
-
-        self.equity *= (1 + e)
-        self.bonds *= (1 + b)
-        self.other *= (1 + o)
+    def addInvestmentEarnings(self):
+        rates = self.nextRates()
 
-        self.equity = round(self.equity, 2)
-        self.bonds = round(self.bonds, 2)
-        self.other = round(self.other, 2)
+        A = self.assets.sum()
+        self.assets *= 1 + rates
 
-        newA = self.equity + self.bonds + self.other
-        try:
-            r = (newA-A)/A
-        except ZeroDivisionError:
-            r = 0.0
+        newA = self.assets.sum()
+        r = (newA-A)/A if A else 0.0
         return [r, A]
 
     def updateLedger(self, year):
         self.currentYear = year
-        self.ledger[self.currentYear] = [self.equity, self.bonds, self.other]
+        row = year - self.startYear
+        if row >= len(self.ledger):
+            # Past the years hint: grow the ledger, doubling it so this stays rare.
+            grown = np.full((max(2 * len(self.ledger), row + 1), 3), np.nan)
+            grown[:len(self.ledger)] = self.ledger
+            self.ledger = grown
+        self.ledger[row] = self.assets
 
 
 ##### TESTING #####
@@ -1,15 +1,17 @@
 #!/usr/bin/env python3
-from pensPop import pensPop, pensMort
-from pensFund import pensFund
-import plotly.express as px
-import pandas as pd
-import statistics as stats
+from pensPop import pensPop, loadTables, setTables
+from pensFund import pensFund, simulateFunds
+import numpy as np
+import random
 import os
+import itertools
+from functools import partial
+from multiprocessing import Pool, cpu_count
 
 
 class pensPlan(object):
     def __init__(self, currentYear, volatility, employmentGrowth=1.0, discountRate=0.07,
-                 funds=0.75, premiumRate=1.0, tables=None):
+                 funds=0.75, premiumRate=1.0, tables=None, years=0, seed=None, rng=None):
 
         self.currentYear = currentYear
         self.employ = employmentGrowth
@@ -25,11 +27,12 @@ class pensPlan(object):
         self.population = pensPop([], self.discountRate, tables)
         self.population.simulatePopulation()
 
-        self.liability = round(self.population.calculateTotalLiability(), 2)
+        self.liability = self.population.calculateTotalLiability()
 
-        self.fund = pensFund(funds * self.liability, self.currentYear, volatility)
-        self.ual = round(self.liability - sum(self.fund.ledger[self.currentYear]), 2)
-        self.assets = sum(self.fund.ledger[self.currentYear])
+        # years is a hint of how long the plan will be run, so the fund can draw its returns up front.
+        self.fund = pensFund(funds * self.liability, self.currentYear, volatility, years=years, seed=seed, rng=rng)
+        self.assets = float(self.fund.assets.sum())
+        self.ual = self.liability - self.assets
 
         self.growthRate = 0.0
 
@@ -38,7 +41,7 @@ class pensPlan(object):
         self.population.printReport()
 
         # Show current liability
-        print("Current Liability: $%s" % '{:,}'.format(round(self.liability, 2)))
+        print(f"Current Liability: ${self.liability:,.2f}")
 
         # Show assets
         self.fund.printReport()
@@ -48,34 +51,41 @@ class pensPlan(object):
 
         # UAL
         if self.ual > 0:
-            print("Unfunded Liability: $%s (%s%%)" % ('{:,}'.format(round(self.ual, 2)),
-                                                      round((self.ual / self.liability) * 100)))
+            print(f"Unfunded Liability: ${self.ual:,.2f} ({self.ual / self.liability:.0%})")
         else:
             print("Unfunded Liability: $0")
 
-    def advanceOneYear(self):
+    def advancePopulation(self):
+        """Advance the members by a year and update the liability and total
+        salary. Returns the population info, the growth in active members and
+        the normal cost, which are all the fund side of the year needs."""
         self.currentYear += 1
         info = self.population.advanceOneYear()
-        old_assets = self.assets
 
         # variable to record growth in active population after hiring new members.
-        popGrowth = sum([m.status == 'active' for m in self.population.members])
+        popGrowth = self.population.n_active
         self.population.hireReplacements(info['replace'], self.employ)
-        popGrowth = sum([m.status == 'active' for m in self.population.members]) - popGrowth
+        popGrowth = self.population.n_active - popGrowth
 
         ## Calculate the increment of the normal cost.
-        newLiability = round(self.population.calculateTotalLiability(), 2)
+        newLiability = self.population.calculateTotalLiability()
         normalCost = (newLiability - self.liability)
         self.liability = newLiability
-        self.totalPay = round(self.population.calculateTotalSalary(), 2)
+        self.totalPay = self.population.calculateTotalSalary()
+
+        return info, popGrowth, normalCost
+
+    def advanceOneYear(self, verbose=False):
+        """Advance the plan by a year. If verbose, print the annual report
+        afterwards; Monte Carlo runs leave it off."""
+        info, popGrowth, normalCost = self.advancePopulation()
 
-        [r, A] = self.fund.addInvestmentEarnings()
-        self.r = round(r*100, 2)
         contribution = self.pr * normalCost
-        self.fund.addPremiums(contribution)
-        self.payGo = round(self.fund.payBenefits(info['benefit']), 2)
+        [r, A, payGo, total] = self.fund.annualStep(contribution, info['benefit'])
+        self.r = r*100
+        self.payGo = payGo
         self.fund.updateLedger(self.currentYear)
-        self.assets = sum(self.fund.ledger[self.currentYear])
+        self.assets = total
 
         # instability represents proximity to hypothesised equilibrium.
         self.instability = (contribution + self.discountRate*self.liability) - (r*A + normalCost)
@@ -98,9 +108,18 @@ class pensPlan(object):
                 self.growthRate = newUAL * 100 / self.liability
             else:
                 self.growthRate = 0.0
-        self.growthRate = round(self.growthRate, 2)
         self.ual = newUAL
 
+        if verbose:
+            self.annualReport()
+
+    def getAnnualData(self):
+        """The current year's values, in METRIC_COLS order. The plan's state is
+        kept unrounded; this is where values are rounded for reporting."""
+        return [round(self.ual, 2), round(self.assets, 2), round(self.liability, 2), round(self.growthRate, 2),
+                self.population.n_active, self.population.n_retired, round(self.population.getAvgService()), self.cr,
+                round(self.payGo, 2), round(self.totalPay, 2), round(self.instability), round(self.r, 2)]
+
     def adjustEmployment(self, N):
         """Adjust employment up or down."""
         if N > 0:
@@ -109,53 +128,56 @@ class pensPlan(object):
             self.population.layoffMembers(-N)
 
 
+# Columns of the annual data arrays returned by runModel() and runModelBatch().
+METRIC_COLS = ["UAL", "Assets", "Liability", "UAL Growth(%)", "Active Members", "Retired Members", "Avg. Service",
+               "Contribution Rate", "payGo", "Total Salary", "Instability", "Investment Returns(%)"]
+# Index of each column, by name.
+COL = {key: METRIC_COLS.index(key) for key in METRIC_COLS}
+# Columns that are reported as whole numbers.
+INT_COLS = [COL[key] for key in ["Active Members", "Retired Members", "Avg. Service", "Instability"]]
+# Number of batches getModelData() splits its runs into, each simulating its own population.
+N_CHUNKS = 4
+
+
 def runModel(volatility, employmentGrowth=1.0, discountRate=0.07, funds=0.75, premiums=1.0, years=40, saveFiles=False,
-             filename="plotly_graph", tables=None):
-    # Create Plan and dictionary to keep track of annual data
-    d = {}
-    p = pensPlan(2000, volatility, employmentGrowth, discountRate, funds, premiums, tables=tables)
+             filename="plotly_graph", tables=None, seed=None, verbose=False):
+    # Seed the population's random generators too, if asked, so the whole run is reproducible.
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
 
-    d["UAL"] = [p.ual]
-    d["Assets"] = [p.assets]
-    d["Liability"] = [p.liability]
-    d["UAL Growth(%)"] = [round(p.growthRate, 2)]
-    d["Active Members"] = [sum([m.status == 'active' for m in p.population.members])]
-    d["Retired Members"] = [sum([m.status == 'retired' for m in p.population.members])]
-    d["Avg. Service"] = [round(p.population.getAvgService())]
-    d["Contribution Rate"] = [p.cr]
-    d["payGo"] = [p.payGo]
-    d["Total Salary"] = [p.totalPay]
-    d["Instability"] = [round(p.instability)]
-    d["Investment Returns(%)"] = [p.r]
+    # Create Plan and array to keep track of annual data, one row per year.
+    d = np.empty((years + 1, len(METRIC_COLS)))
+    p = pensPlan(2000, volatility, employmentGrowth, discountRate, funds, premiums, tables=tables, years=years,
+                 seed=seed)
 
     # Run model for several years, saving data along the way
-    for year in range(years):
-        p.advanceOneYear()
-        d["UAL"].append(p.ual)
-        d["Assets"].append(p.assets)
-        d["Liability"].append(p.liability)
-        d["UAL Growth(%)"].append(round(p.growthRate, 2))
-        d["Active Members"].append(sum([m.status == 'active' for m in p.population.members]))
-        d["Retired Members"].append(sum([m.status == 'retired' for m in p.population.members]))
-        d["Avg. Service"].append(round(p.population.getAvgService()))
-        d["Contribution Rate"].append(p.cr)
-        d["payGo"].append(p.payGo)
-        d["Total Salary"].append(p.totalPay)
-        d["Instability"].append(round(p.instability))
-        d["Investment Returns(%)"].append(p.r)
+    for year in range(years + 1):
+        if year > 0:
+            p.advanceOneYear(verbose)
+        d[year] = p.getAnnualData()
 
     # Stops here if you're not trying to save the data visualization.
     if not saveFiles:
         return d
 
-    # Convert dictionary data into a DataFrame, used to create the graph.
-    df = pd.DataFrame(data=d, index=range(2000, (2001 + years)))
+    saveModel(d, employmentGrowth, discountRate, funds, filename)
 
-    # Create the graph itself.
-    fig = px.line(df)
+    return d
 
-    # Save graph as HTML file in the appropriate folder. If no such directory exists yet, create it.
-    # HTML files can be opened to view interactive plotly visualization.
+
+def saveCSV(path, d):
+    """Write annual data (one row per year from 2000, columns as in METRIC_COLS) to a CSV file."""
+    index = np.arange(2000, 2000 + len(d))
+    fmt = "%.9g" if d.dtype == np.float32 else "%.15g"
+    np.savetxt(path, np.column_stack([index, d]), fmt=fmt, delimiter=",", header=",".join([""] + METRIC_COLS),
+               comments="")
+
+
+def saveModel(d, employmentGrowth, discountRate, funds, filename):
+    """Save the annual data of a single model run as a CSV. Only getModelData()
+    draws plotly graphs, for the mean data."""
+    # Save the CSV file in the appropriate folder. If no such directory exists yet, create it.
     folder = "eg=%s_dr=%s_f=%s" % (str(employmentGrowth), str(discountRate), str(funds))
     try:
         os.makedirs('Graphs/%s' % folder)
@@ -166,19 +188,101 @@ def runModel(volatility, employmentGrowth=1.0, discountRate=0.07, funds=0.75, pr
     count = 1
     temp = filename
     filename = "%s_%s" % (temp, str(count))
-    directory = "Graphs/%s/%s.html" % (folder, filename)
-    while os.path.exists(directory):
+    csv_directory = "Graphs/%s/%s.csv" % (folder, filename)
+    while os.path.exists(csv_directory):
         count += 1
         filename = "%s_%s" % (temp, str(count))
-        directory = "Graphs/%s/%s.html" % (folder, filename)
-
-    csv_directory = "Graphs/%s/%s.csv" % (folder, filename)
-    df.to_csv(csv_directory)
-    fig.write_html(directory)
+        csv_directory = "Graphs/%s/%s.csv" % (folder, filename)
+
+    saveCSV(csv_directory, d)
+
+
+def runModelBatch(volatility, employmentGrowth=1.0, discountRate=0.07, funds=0.75, premiums=1.0, size=50, years=40,
+                  tables=None, seed=None, rng=None, dtype=np.float64):
+    """Run `size` models at once. The population (and so the liability, salary
+    and normal cost) is simulated once and shared by every run; only the fund
+    is batched, each run drawing its own investment returns. Returns a
+    (size, years + 1, len(METRIC_COLS)) array: runModel()'s output for each run.
+    If a seed is given, all the random generators are seeded with it first. The
+    investment returns come from rng, a numpy Generator made from seed by default.
+    dtype: float64 by default; float32 is less precise."""
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+    if rng is None:
+        rng = np.random.default_rng(seed)
+    p = pensPlan(2000, volatility, employmentGrowth, discountRate, funds, premiums, tables=tables)
+    d = np.empty((size, years + 1, len(METRIC_COLS)), dtype)
+    d[:, 0] = p.getAnnualData()
+
+    # The population doesn't depend on the fund, so simulate all of its years first.
+    liability = np.empty(years)
+    totalPay = np.empty(years)
+    normalCost = np.empty(years)
+    benefit = np.empty(years)
+    popGrowth = np.empty(years)
+    for t in range(years):
+        info, popGrowth[t], normalCost[t] = p.advancePopulation()
+        benefit[t] = info['benefit']
+        liability[t] = p.liability
+        totalPay[t] = p.totalPay
+        d[:, t + 1, COL["Active Members"]] = p.population.n_active
+        d[:, t + 1, COL["Retired Members"]] = p.population.n_retired
+        d[:, t + 1, COL["Avg. Service"]] = round(p.population.getAvgService())
+
+    # Then run every fund through every year at once. The results are (years, size) arrays.
+    vol = np.asarray(volatility, dtype)
+    rates = rng.standard_normal((years, size, 3), dtype) * vol[1::2] + vol[0::2]
+    contribution = (p.pr * normalCost).astype(dtype)
+    total, r, A, payGo = simulateFunds(p.fund.assets.astype(dtype), p.fund.pcts.astype(dtype), rates, contribution,
+                                       benefit.astype(dtype))
+
+    # Per-year values, shaped to broadcast against the runs.
+    liability = liability[:, None].astype(dtype)
+    totalPay = totalPay[:, None].astype(dtype)
+    normalCost = normalCost[:, None].astype(dtype)
+    popGrowth = popGrowth[:, None]
+
+    instability = (contribution[:, None] + discountRate * liability) - (r * A + normalCost)
+
+    # Contribution rate is per new member when the active population grew.
+    payroll = np.where(popGrowth != 0, totalPay * popGrowth, totalPay)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cr = np.where(payroll != 0, (normalCost + payGo) / payroll, 0.0)
+
+    ual = np.maximum(liability - total - payGo, 0)
+    prevUAL = np.concatenate([np.full((1, size), p.ual, dtype), ual[:-1]])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        growthRate = np.where(prevUAL != 0, (ual - prevUAL) * 100 / prevUAL,
+                              np.where(ual != 0, ual * 100 / liability, 0.0))
+
+    # Rounded like pensPlan.getAnnualData(); the population columns were filled in above.
+    d[:, 1:, COL["UAL"]] = ual.round(2).T
+    d[:, 1:, COL["Assets"]] = total.round(2).T
+    d[:, 1:, COL["Liability"]] = liability.round(2).T
+    d[:, 1:, COL["UAL Growth(%)"]] = growthRate.round(2).T
+    d[:, 1:, COL["Contribution Rate"]] = cr.T
+    d[:, 1:, COL["payGo"]] = payGo.round(2).T
+    d[:, 1:, COL["Total Salary"]] = totalPay.round(2).T
+    d[:, 1:, COL["Instability"]] = np.round(instability).T
+    d[:, 1:, COL["Investment Returns(%)"]] = np.round(r * 100, 2).T
 
     return d
 
 
+def runModelTask(task, volatility, employmentGrowth, discountRate, funds, premiums, years, tables=None,
+                 dtype=np.float64):
+    """Pool entry point for getModelData(): runs one (size, rng) chunk of the batch."""
+    size, rng = task
+    # Forked workers start with copies of the parent's global random state, so reseed the population's
+    # generators from this chunk's own stream. getModelData() restores them when it runs this in-process.
+    seed = int(rng.integers(2 ** 32))
+    random.seed(seed)
+    np.random.seed(seed)
+    return runModelBatch(volatility, employmentGrowth, discountRate, funds, premiums, size, years, tables=tables,
+                         rng=rng, dtype=dtype)
+
+
 def getModelData(volatility,
                  employmentGrowth=1.0,
                  discountRate=0.07,
@@ -188,7 +292,23 @@ def getModelData(volatility,
                  years=100,
                  saveAll=True,
                  filename="data_1",
-                 tables=None):
+                 tables=None,
+                 seed=None,
+                 n_workers=None,
+                 dtype=np.float64):
+    # The runs are split into (up to) N_CHUNKS batches, each with its own simulated population. The split doesn't
+    # depend on n_workers, so the same seed gives the same runs on any machine.
+    # n_workers defaults to min(cpu_count(), N_CHUNKS); 1 runs every batch in this process.
+    # dtype is passed on to runModelBatch().
+    n_chunks = min(N_CHUNKS, size)
+    if n_workers is None:
+        n_workers = min(cpu_count(), N_CHUNKS)
+    n_workers = max(min(n_workers, n_chunks), 1)
+
+    # Build the mortality tables once here, rather than in every worker.
+    if tables is None:
+        tables = loadTables()
+
     # Create directory for data visualization, if necessary.
     folder = "eg=%s_dr=%s_f=%s" % (str(employmentGrowth), str(discountRate), str(funds))
     if not os.path.exists('Graphs/%s' % folder):
@@ -212,58 +332,69 @@ def getModelData(volatility,
             filename = "%s_%s" % (temp, str(count))
             directory = "Graphs/%s/%s.html" % (folder, filename)
 
-    # If you wish to visualize the data of each individual model, in addition to the mean data...
+    # If you wish to save the data of each individual model, in addition to the mean data...
     if saveAll:
-        # Create a folder to hold individual model graphs, based on the mean data filename
+        # Create a folder to hold individual model CSVs, based on the mean data filename
         if not os.path.exists('Graphs/%s/%s' % (folder, filename)):
             os.makedirs('Graphs/%s/%s' % (folder, filename))
 
-        # All individual model graphs will be named graph_1, graph_2, graph_3, etc. and placed within the above folder
-        # (The numbers are added within the runModel() function.)
+        # All individual model CSVs will be named model_1.csv, model_2.csv, model_3.csv, etc. and placed within the
+        # above folder. (The numbers are added within the saveModel() function.)
         subdir = "%s/model" % filename
 
     else:
         subdir = None
 
-    # Create list to store the data from each run.
-    model_data = []
-
     #Print for checking progress
     print("%s:" % filename)
     print("\tRunning models...")
 
-    for i in range(size):
-        # Run the model, then append the resulting dictionary to the list.
-        # Set saveAll to True if you want to save individual run visualizations.
-
-        try:
-            model_data.append(
-                runModel(volatility, employmentGrowth, discountRate, funds, premiums, years, saveFiles=saveAll,
-                         filename=subdir, tables=tables))
-        except:
-            print("\nAn error occurred while running models.\n%s out of %s models completed." % (str(i), str(size)))
-            raise
+    # Each batch gets its own independent random stream, spawned from seed.
+    sizes = [len(chunk) for chunk in np.array_split(np.arange(size), n_chunks)]
+    streams = np.random.default_rng(seed).spawn(n_chunks)
+    run = partial(runModelTask, volatility=volatility, employmentGrowth=employmentGrowth, discountRate=discountRate,
+                  funds=funds, premiums=premiums, years=years, dtype=dtype)
+    try:
+        if n_workers == 1:
+            # runModelTask() reseeds the global random generators, so give the caller theirs back afterwards.
+            state = random.getstate(), np.random.get_state()
+            try:
+                chunks = [run(task, tables=tables) for task in zip(sizes, streams)]
+            finally:
+                random.setstate(state[0])
+                np.random.set_state(state[1])
+        else:
+            # Each worker is handed the tables once, as its shared TABLES, rather than with every task.
+            # imap rather than imap_unordered, so the runs (and model_1.csv, model_2.csv, ...) stay in batch order.
+            with Pool(n_workers, initializer=setTables, initargs=(tables,)) as pool:
+                chunks = list(pool.imap(run, zip(sizes, streams)))
+    except:
+        print("\nAn error occurred while running models.")
+        raise
+    model_data = np.concatenate(chunks)
+
+    # Save the individual run CSVs, if requested. Files are only written here, once every worker is done.
+    if saveAll:
+        for i in range(size):
+            saveModel(model_data[i], employmentGrowth, discountRate, funds, subdir)
 
     print("\tcomplete! Averaging data...")
 
     # Find the mean values across all runs and visualize them, to see overall shape of the data w/ the given parameters.
-    mean_data = {"UAL": [], "Assets": [], "Liability": [], "UAL Growth(%)": [], "Active Members": [],
-                 "Retired Members": [], "Avg. Service": [], "Contribution Rate": [], "payGo": [],
-                 "Total Salary": [], "Instability": [], "Investment Returns(%)": []}
-    for i in range(years):
-        for key in mean_data:
-            m = [run[key][i] for run in model_data]
-            if key == "Active Members" or key == "Retired Members" or key == "Avg. Service" or key == "Instability":
-                mean = round(stats.mean(m))
-            else:
-                mean = round(stats.mean(m), 2)
-            mean_data[key].append(mean)
+    mean = model_data[:, :years].mean(axis=0, dtype=np.float64)
+    mean_data = np.round(mean, 2)
+    mean_data[:, INT_COLS] = np.rint(mean[:, INT_COLS])
 
     print("\tcomplete!")
-    # Convert dictionary data into a DataFrame, used to create the graph.
-    df = pd.DataFrame(data=mean_data, index=range(2000, (2000 + years)))
     csv_directory = "Graphs/%s/%s.csv" % (folder, filename)
-    df.to_csv(csv_directory)
+    saveCSV(csv_directory, mean_data)
+
+    # plotly and pandas are only needed for this graph, so they're imported here rather than by every worker process.
+    import plotly.express as px
+    import pandas as pd
+
+    # Convert the data into a DataFrame, used to create the graph.
+    df = pd.DataFrame(data=mean_data, columns=METRIC_COLS, index=range(2000, (2000 + years)))
 
     # Create the graph and save it as HTML file in the appropriate folder.
     fig = px.line(df)
@@ -285,8 +416,8 @@ def setupFolders():
 if __name__ == "__main__":
     # Create directories for storing graphs, if necessary
     setupFolders()
-    tables = [pensMort("F", "General").mortTable, pensMort("F", "Safety").mortTable,
-              pensMort("M", "General").mortTable, pensMort("M", "Safety").mortTable]
+    # Loaded once here and handed to every getModelData() call, rather than parsed again for each one.
+    tables = loadTables()
 
     # Volatility values to be used throughout. List contains mean and std. deviation (in that order) for the three
     # investment channels in pensFund.
@@ -308,17 +439,14 @@ if __name__ == "__main__":
     #name = ("M7S0_premiums=%s" % str(pr))
 
     print("Beginning premiumRate tests.\n")
-    eg = 0.5
-    while eg <= 1.5:
-        f = 0.5
-        while f <= 1.5:
-            pr = 0.5
+    # Each combination writes its own files. The combinations run one after another because getModelData() already
+    # spreads each one's runs across a pool of worker processes.
+    values = [0.5, 1.0, 1.5]
+    for eg, f, pr in itertools.product(values, values, values):
+        if pr == values[0]:
             print("[EG=%s, F=%s]" % (eg, f))
-            while pr <= 1.5:
-                name = ("M7S0_premiums=%s" % str(pr))
-                getModelData(vol, eg, dr, f, pr, size=size, years=years, filename=name, tables=tables)
-                pr += 0.5
+        name = ("M7S0_premiums=%s" % str(pr))
+        getModelData(vol, eg, dr, f, pr, size=size, years=years, filename=name, tables=tables)
+        if pr == values[-1]:
             print()
-            f += 0.5
-        eg += 0.5
     print("\nFinished premiumRate tests!\n")
@@ -6,7 +6,29 @@ import pandas as pd
 import openpyxl
 from pathlib import Path
 from copy import deepcopy
-from matplotlib import pyplot as plt
+
+# The four mortality tables as one (4, age, 4) array, in the order pensMember
+# indexes them: F General, F Safety, M General, M Safety. Filled in once by
+# loadTables(), or handed over with setTables(), and shared from then on.
+TABLES = None
+
+
+def loadTables():
+    """Parse the mortality tables into TABLES the first time it's called, and
+    return the shared array."""
+    global TABLES
+    if TABLES is None:
+        TABLES = np.stack([pensMort(sex, mortalityClass).getMortalityArray()
+                           for sex, mortalityClass in [("F", "General"), ("F", "Safety"),
+                                                       ("M", "General"), ("M", "Safety")]])
+    return TABLES
+
+
+def setTables(tables):
+    """Use the given array as the shared TABLES, e.g. in a worker process that
+    was handed the parent's tables rather than parsing them again."""
+    global TABLES
+    TABLES = tables
 
 
 class pensMort:
@@ -82,6 +104,16 @@ class pensMort:
                 ]
             return temp
 
+    def getMortalityArray(self):
+        """The mortality table as a contiguous array indexed [age, rate], with
+        the rates in the same order as mortTable. Ages the table doesn't cover,
+        and blank rates, are 0."""
+        ages = [age for age in self.mortTable if isinstance(age, int)]
+        out = np.zeros((max(ages) + 1, 4))
+        for age in ages:
+            out[age] = [rate if rate != "" else 0 for rate in self.mortTable[age]]
+        return out
+
 
 class pensMember(object):
     def __init__(
@@ -113,6 +145,7 @@ class pensMember(object):
         self.pension = self.salary * 0.55
         self.cola = 1.025  # inflation, set to 1 to neutralize
         self.mortDict = 0
+        self.liability = 0  # last accrued liability worked out by pensPop
         self.yearSalaryDict = {}
         self.salaryHistory = deque([salary])
         self.simulateCareerBackward()
@@ -243,25 +276,16 @@ class pensMember(object):
 
     def getMortTable(self):
         """determine with mortality dictionary to use based on pensMember sex and mortality class"""
-        if self.tables is None:
-            if self.sex == "F":
-                if self.mortalityClass == "General":
-                    self.mortDict = pensMort("F", "General").mortTable
-                if self.mortalityClass == "Safety":
-                    self.mortDict = pensMort("F", "Safety").mortTable
-
-            elif self.sex == "M":
-                if self.mortalityClass == "General":
-                    self.mortDict = pensMort("M", "General").mortTable
-                if self.mortalityClass == "Safety":
-                    self.mortDict = pensMort("M", "Safety").mortTable
-        else:
-            index = 0
-            if self.sex == "M":
-                index += 2
-            if self.mortalityClass == "Safety":
-                index += 1
-            self.mortDict = self.tables[index]
+        # Members keep a reference into the shared tables, never a copy.
+        tables = self.tables
+        if tables is None:
+            tables = loadTables()
+        index = 0
+        if self.sex == "M":
+            index += 2
+        if self.mortalityClass == "Safety":
+            index += 1
+        self.mortDict = tables[index]
 
     def doesMemberDie(self):
         """TBD: Check if member dies"""
@@ -339,6 +363,14 @@ class pensPop(object):
         self.startingSalary = 50000
         self.avgAge = 30
         self.sampleSize = 100
+        # Running counts of active and retired members, kept up to date as members change status.
+        self.n_active = 0
+        self.n_retired = 0
+        # Present value factors for calculateLiability(), by (discount rate, cola).
+        self.pvFactors = {}
+        # Running totals over all members, or None when they need working out again.
+        self.total_liability = None
+        self.total_salary = None
         self.simulatePopulation()
         self.discount = 1 + discountRate
 
@@ -542,6 +574,9 @@ class pensPop(object):
             age_lower += 5
             age_upper += 5
 
+        self.recount()
+        self.invalidate()
+
         ## data source: California State Teacher's Retiremenet System (p.75-76)
         ## https://www.calstrs.com/sites/main/files/file-attachments/db-valuation-2019.pdf
 
@@ -551,17 +586,38 @@ class pensPop(object):
         or separate. """
         retirementBenefit = 0
         replacements = 0
+        retirements = 0
+        revalue = []
+        totalSalary = 0
         for member in self.members:
             wasActive = False
+            wasRetired = False
             if member.status == "active":
                 wasActive = True
+            elif member.status == "retired":
+                wasRetired = True
             member.ageOneYear()
             if member.status == "retired":
                 retirementBenefit += member.pension
                 if wasActive:
                     replacements += 1
-            elif member.status != "active" and wasActive:
-                replacements += 1
+                    retirements += 1
+            elif member.status != "active":
+                if wasActive:
+                    replacements += 1
+                elif wasRetired:
+                    retirements -= 1
+
+            # Separated and deceased members have no liability or salary left, so only the
+            # members who started the year active or retired need revaluing.
+            if wasActive or wasRetired:
+                revalue.append(member)
+                totalSalary += member.salary
+
+        self.n_active -= replacements
+        self.n_retired += retirements
+        self.total_liability = self.valueMembers(revalue)
+        self.total_salary = totalSalary
 
         return {"benefit": retirementBenefit, "replace": replacements}
 
@@ -569,14 +625,15 @@ class pensPop(object):
         """TBD: Replace retired and separated workers to maintain headcount.
         If pct is less than one, only replace that proportion of the retired
         and separated."""
-        self.members.extend(
-            self.simulateMembers(
-                int(N * pct),
-                ageRange=(self.avgAge - 5, self.avgAge + 5),
-                serviceRange=(0, 1),
-                avgSalary=self.startingSalary,
-            )
+        newMembers = self.simulateMembers(
+            int(N * pct),
+            ageRange=(self.avgAge - 5, self.avgAge + 5),
+            serviceRange=(0, 1),
+            avgSalary=self.startingSalary,
         )
+        self.members.extend(newMembers)
+        self.n_active += len(newMembers)
+        self.addToTotals(newMembers)
 
     def addNewMembers(
             self,
@@ -590,14 +647,15 @@ class pensPop(object):
     ):
         """TBD: New hires who aren't replacements."""
 
-        self.members.extend(
-            self.simulateMembers(
-                N,
-                ageRange=(25, 35),
-                serviceRange=(0, 5),
-                avgSalary=self.estimateSalary(2),
-            )
+        newMembers = self.simulateMembers(
+            N,
+            ageRange=(25, 35),
+            serviceRange=(0, 5),
+            avgSalary=self.estimateSalary(2),
         )
+        self.members.extend(newMembers)
+        self.n_active += len(newMembers)
+        self.addToTotals(newMembers)
 
     def layoffMembers(self, N):
         """TBD: Remove given number of members.  Favor removal of the
@@ -607,14 +665,42 @@ class pensPop(object):
             for m in self.members:
                 if m.age >= 20 and m.age <= 25:
                     self.members.remove(m)
+                    if m.status == "active":
+                        self.n_active -= 1
+                    elif m.status == "retired":
+                        self.n_retired -= 1
+                    if self.total_liability is not None:
+                        self.total_liability -= m.liability
+                    if self.total_salary is not None:
+                        self.total_salary -= m.salary
+
+    def recount(self):
+        """Recount the active and retired members from scratch, e.g. to audit
+        the running counters or after changing self.members directly."""
+        self.n_active = sum([m.status == "active" for m in self.members])
+        self.n_retired = sum([m.status == "retired" for m in self.members])
+
+    def invalidate(self):
+        """Drop the running liability and salary totals after a bulk change to
+        self.members; they are worked out again the next time they're asked for."""
+        self.total_liability = None
+        self.total_salary = None
+
+    def addToTotals(self, members):
+        """Add newly joined members to the running liability and salary totals."""
+        if self.total_liability is not None:
+            self.total_liability += self.valueMembers(members)
+        if self.total_salary is not None:
+            for m in members:
+                self.total_salary += m.salary
 
     def printReport(self):
         print(
             "N: %.0f members, %0.f active, %0.f retired, %0.f separated, %0.f deceased"
             % (
                 len(self.members),
-                sum([m.status == "active" for m in self.members]),
-                sum([m.status == "retired" for m in self.members]),
+                self.n_active,
+                self.n_retired,
                 sum([m.status == "separated" for m in self.members]),
                 sum([m.status == "deceased" for m in self.members]),
             )
@@ -622,13 +708,15 @@ class pensPop(object):
         sal = sum([m.salary for m in self.members]) / len(self.members)
         print("Average salary: $%s" % "{:,}".format(round(sal, 2)))
 
-    def calculateLiability(self, member, discountrate, cola):
-        """TBD: Estimate accrued liability for this member."""
+    def estimateBenefitYears(self, member):
+        """Simulate the rest of a member's life to estimate how many years of
+        benefits their accrued liability covers."""
 
         ## Step 1: if person is active, estimate year of retirement
         ## ET: created a deep copy of the member so not to effect the actual member's attribute
         ## when generating annual report
-        simulateMemberLife = deepcopy(member)
+        ## The mortality tables are shared, not part of the member, so leave them out of the copy.
+        simulateMemberLife = deepcopy(member, {id(member.tables): member.tables, id(member.mortDict): member.mortDict})
 
         yearsUntilRetirement = 0
         if simulateMemberLife.status == "active":
@@ -646,32 +734,53 @@ class pensPop(object):
                 yearsOfRetirement += 1
                 simulateMemberLife.ageOneYear()
 
-        liabilityPresentValue = 0
-        for i in range(yearsUntilRetirement + yearsOfRetirement):
-            ## Step 3: estimate retirement benefit earned
-            liability = member.pension * cola ** (i - 1)
+        return yearsUntilRetirement + yearsOfRetirement
+
+    def getPVFactors(self, discountrate, cola, horizon):
+        """Returns an array whose n-th entry is the present value of n years of
+        a pension of 1, for every n up to at least horizon. These are worked
+        out once per discount rate and cola, not once per member."""
+        factors = self.pvFactors.get((discountrate, cola))
+        if factors is None or len(factors) <= horizon:
+            i = np.arange(max(2 * horizon, 100))
+            ## Step 3: estimate retirement benefit earned each year (per
+            ## unit of pension). Step 4: apply the discount rate for each
+            ## of the years to get the present value in the current year.
+            factors = np.concatenate(([0.0], np.cumsum(cola ** (i - 1) / discountrate ** i)))
+            self.pvFactors[(discountrate, cola)] = factors
+        return factors
 
-            ## Step 4: Apply the discount rate for each of the years to
-            ## get the present value in the current year.
-            liabilityPresentValue = liabilityPresentValue + (liability) / (
-                    discountrate ** i
-            )
-        return liabilityPresentValue
+    def calculateLiability(self, member, discountrate, cola):
+        """TBD: Estimate accrued liability for this member."""
+        years = self.estimateBenefitYears(member)
+        return member.pension * self.getPVFactors(discountrate, cola, years)[years]
+
+    def valueMembers(self, members):
+        """Work out the accrued liability of several members at once, at the
+        plan's discount rate, and save it on each member. Returns the total."""
+        if len(members) == 0:
+            return 0
+        years = np.array([self.estimateBenefitYears(m) for m in members])
+        factors = self.getPVFactors(self.discount, 1.02, years.max())
+        liabilities = np.array([m.pension for m in members]) * factors[years]
+        for m, liability in zip(members, liabilities.tolist()):
+            m.liability = liability
+        return float(liabilities.sum())
 
     def calculateTotalLiability(self):
         """Calculate the present value of the liability, aka normal cost, for all the
             members."""
 
-        sum = 0
-        for m in self.members:
-            sum += self.calculateLiability(m, self.discount, 1.02)
-        return sum
+        if self.total_liability is None:
+            self.total_liability = self.valueMembers(self.members)
+        return self.total_liability
 
     def calculateTotalSalary(self):
-        total_salary = 0
-        for m in self.members:
-            total_salary += m.salary
-        return total_salary
+        if self.total_salary is None:
+            self.total_salary = 0
+            for m in self.members:
+                self.total_salary += m.salary
+        return self.total_salary
 
     def getAnnualReport(self):
 
@@ -771,6 +880,8 @@ if __name__ == "__main__":
 
 
     def testSimulatePopulation():
+        from matplotlib import pyplot as plt
+
         total_retired = 270835
         x = pensPop()
         counter = []
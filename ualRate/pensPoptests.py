@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-from pensPop import pensMember
+from pensPop import pensMember, pensPop
 
 
 def testdoesMemberRetire():
@@ -21,7 +21,41 @@ def testdoesMemberSeparate():
     print(counter)
 
 
+def checkRunningTotals(pop, step):
+    n_active, n_retired = pop.n_active, pop.n_retired
+    pop.recount()
+    if (n_active, n_retired) != (pop.n_active, pop.n_retired):
+        print("wrong member counts after %s" % step)
+    if pop.total_salary is not None:
+        if abs(pop.total_salary - sum([m.salary for m in pop.members])) > 1e-6 * max(pop.total_salary, 1):
+            print("wrong total salary after %s" % step)
+    if pop.total_liability is not None:
+        if abs(pop.total_liability - sum([m.liability for m in pop.members])) > 1e-6 * max(pop.total_liability, 1):
+            print("wrong total liability after %s" % step)
+
+
+def testRunningTotals():
+    # Fill in the liability and salary totals one at a time, then both, as pensPlan does.
+    for first in ["liability", "salary", "both"]:
+        pop = pensPop([])
+        if first != "salary":
+            pop.calculateTotalLiability()
+        if first != "liability":
+            pop.calculateTotalSalary()
+
+        pop.hireReplacements(20)
+        checkRunningTotals(pop, "hire (%s first)" % first)
+        pop.layoffMembers(5)
+        checkRunningTotals(pop, "layoff (%s first)" % first)
+        for i in range(3):
+            pop.advanceOneYear()
+            checkRunningTotals(pop, "advance (%s first)" % first)
+            pop.hireReplacements(10)
+            checkRunningTotals(pop, "hire after advance (%s first)" % first)
+
+
 if __name__ == "__main__":
     testdoesMemberRetire()
     testdoesMemberSeparate()
+    testRunningTotals()
 
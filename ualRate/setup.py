@@ -0,0 +1,10 @@
+#!/usr/bin/env python3
+"""Builds the optional fundStep extension, for machines without numba:
+
+    python setup.py build_ext --inplace
+"""
+from setuptools import setup, Extension
+from Cython.Build import cythonize
+
+# The modules here import each other as top-level modules (from pensFund import ...), so fundStep is built as one too.
+setup(ext_modules=cythonize([Extension("fundStep", ["fundStep.pyx"])]))